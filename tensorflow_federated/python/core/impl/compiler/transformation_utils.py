@@ -1114,18 +1114,20 @@ def get_unique_names(comp):
   return names
 
 
-def has_unique_names(comp):
+def has_unique_names(comp, reserved_names=()):
   """Checks that each variable of `comp` is bound at most once.
 
   Args:
     comp: Instance of `building_blocks.ComputationBuildingBlock`.
+    reserved_names: Optional iterable of names which may not be bound anywhere
+      under `comp`, for example the names of references left unbound by `comp`.
 
   Returns:
-    `True` if and only if every variable bound under `comp` uses a unique name.
-    Returns `False` if this condition fails.
+    `True` if and only if every variable bound under `comp` uses a unique name
+    which is not in `reserved_names`. Returns `False` if this condition fails.
   """
   py_typecheck.check_type(comp, building_blocks.ComputationBuildingBlock)
-  names = set()
+  names = set(reserved_names)
   # TODO(b/129791812): Cleanup Python 2 and 3 compatibility
   unique = [True]
 
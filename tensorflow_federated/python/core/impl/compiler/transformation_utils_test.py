@@ -1747,6 +1747,18 @@ class HasUniqueNamesTest(absltest.TestCase):
     single_block = building_blocks.Block([('x', x_data)], lambda_1)
     self.assertTrue(transformation_utils.has_unique_names(single_block))
 
+  def test_returns_false_on_binding_of_reserved_name(self):
+    ref_to_x = building_blocks.Reference('x', tf.int32)
+    lambda_1 = building_blocks.Lambda('x', tf.int32, ref_to_x)
+    self.assertFalse(
+        transformation_utils.has_unique_names(lambda_1, reserved_names=['x']))
+
+  def test_returns_true_without_binding_of_reserved_name(self):
+    ref_to_x = building_blocks.Reference('x', tf.int32)
+    lambda_1 = building_blocks.Lambda('x', tf.int32, ref_to_x)
+    self.assertTrue(
+        transformation_utils.has_unique_names(lambda_1, reserved_names=['y']))
+
 
 if __name__ == '__main__':
   absltest.main()
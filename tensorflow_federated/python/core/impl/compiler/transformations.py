@@ -14,8 +14,12 @@
 # limitations under the License.
 """Contains composite transformations, upon which higher compiler levels depend."""
 
-from typing import Mapping
+import functools
+import itertools
+from typing import Mapping, Optional, Set
+import weakref
 
+from tensorflow_federated.python.common_libs import anonymous_tuple
 from tensorflow_federated.python.common_libs import py_typecheck
 from tensorflow_federated.python.core.impl import transformations
 from tensorflow_federated.python.core.impl import type_utils
@@ -23,6 +27,15 @@ from tensorflow_federated.python.core.impl.compiler import building_block_factor
 from tensorflow_federated.python.core.impl.compiler import building_blocks
 from tensorflow_federated.python.core.impl.compiler import transformation_utils
 
+# `transformations.TFParser` holds no state between calls, so a single instance
+# is shared by every invocation of the TensorFlow generation helpers below.
+_TF_PARSER = transformations.TFParser()
+
+# Caches the result of `transformations.group_block_locals_by_namespace` for
+# each block passed to `create_tensorflow_representing_block`. The cached lists
+# are shared between callers and must not be mutated.
+_NAMESPACE_GROUPING_CACHE = weakref.WeakKeyDictionary()
+
 
 def prepare_for_rebinding(comp):
   """Prepares `comp` for extracting rebound variables.
@@ -71,14 +84,59 @@ def prepare_for_rebinding(comp):
       comp, _transform_fn, symbol_tree)
 
 
+# Upper bound on the number of walks `remove_lambdas_and_blocks` performs with
+# `_FusedCleanup` before giving up on reaching a fixed point.
+_MAX_CLEANUP_PASSES = 8
+
+
+class _FusedCleanup(transformation_utils.TransformSpec):
+  """Chains the cleanup transforms of `remove_lambdas_and_blocks` at each node.
+
+  Applies `ReplaceCalledLambdaWithBlock`, `InlineSelectionsFromTuples` and
+  `RemoveUnusedBlockLocals` to each node visited by
+  `transformation_utils.transform_postorder_with_symbol_bindings`, which must
+  be passed a `transformation_utils.SymbolTree` holding instances of
+  `transformation_utils.TrackRemovedReferences`.
+
+  The two global transforms are only applied to nodes whose bindings are
+  reflected in the symbol tree. Calls and selections which become resolvable
+  through the local variable of a block constructed from a called lambda are
+  left for the next walk performed by `remove_lambdas_and_blocks`, since only a
+  walk of the entire AST has every enclosing binding in scope.
+  """
+
+  def __init__(self):
+    super().__init__(global_transform=True)
+    self._lambda_replacer = transformations.ReplaceCalledLambdaWithBlock()
+    self._selection_inliner = transformations.InlineSelectionsFromTuples()
+    self._unused_locals_remover = transformations.RemoveUnusedBlockLocals()
+
+  def should_transform(self, comp):
+    return isinstance(comp, (building_blocks.Block, building_blocks.Call,
+                             building_blocks.Selection))
+
+  def transform(self, comp, symbol_tree):
+    if not self.should_transform(comp):
+      return comp, False
+    if isinstance(comp, building_blocks.Selection):
+      return self._selection_inliner.transform(comp, symbol_tree)
+    elif isinstance(comp, building_blocks.Call):
+      return self._lambda_replacer.transform(comp, symbol_tree)
+    comp, lambdas_modified = self._lambda_replacer.transform(comp, symbol_tree)
+    comp, locals_modified = self._unused_locals_remover.transform(comp)
+    return comp, lambdas_modified or locals_modified
+
+
 def remove_lambdas_and_blocks(comp):
   """Removes any called lambdas and blocks from `comp`.
 
-  This function will rename all the variables in `comp` in a single walk of the
-  AST, then replace called lambdas with blocks in another walk, since this
-  transformation interacts with scope in delicate ways. It will chain inlining
-  the blocks and collapsing the selection-from-tuple pattern together into a
-  final pass.
+  This function will first replace called lambdas with blocks, inline
+  selections from tuples and remove unused block locals in a single walk of the
+  AST, since these transformations interact with scope in delicate ways. This
+  walk is repeated until it leaves the AST unchanged, up to a bounded number of
+  times. It will then rename all the variables in `comp` in another walk if
+  necessary, and chain inlining the blocks and collapsing the
+  selection-from-tuple pattern together into a final pass.
 
   Args:
     comp: Instance of `building_blocks.ComputationBuildingBlock` from which we
@@ -94,20 +152,24 @@ def remove_lambdas_and_blocks(comp):
   # transforms as currently implemented is insufficient in order to satisfy
   # the purpose of this function. Filing a new bug to followup if this becomes a
   # pressing issue.
+  cleanup = _FusedCleanup()
   modified = False
-  for fn in [
-      transformations.remove_unused_block_locals,
-      transformations.inline_selections_from_tuple,
-      transformations.replace_called_lambda_with_block,
-  ] * 2:
-    comp, inner_modified = fn(comp)
-    modified = inner_modified or modified
-  for fn in [
-      transformations.remove_unused_block_locals,
-      transformations.uniquify_reference_names,
-  ]:
-    comp, inner_modified = fn(comp)
-    modified = inner_modified or modified
+  for _ in range(_MAX_CLEANUP_PASSES):
+    cleanup_symbol_tree = transformation_utils.SymbolTree(
+        transformation_utils.TrackRemovedReferences)
+    comp, pass_modified = transformation_utils.transform_postorder_with_symbol_bindings(
+        comp, cleanup.transform, cleanup_symbol_tree)
+    modified = modified or pass_modified
+    if not pass_modified:
+      break
+  # Renaming is only necessary if some variable is bound more than once, or is
+  # bound under the name of a reference left unbound, which inlining a block
+  # local could otherwise capture.
+  unbound_names = transformation_utils.get_map_of_unbound_references(comp)[comp]
+  if not transformation_utils.has_unique_names(
+      comp, reserved_names=unbound_names):
+    comp, _ = transformations.uniquify_reference_names(comp)
+    modified = True
 
   block_inliner = transformations.InlineBlock(comp)
   selection_replacer = transformations.ReplaceSelectionFromTuple()
@@ -149,6 +211,43 @@ def remove_lambdas_and_blocks(comp):
   return transformed_comp, modified
 
 
+def _insert_identity_and_parse(comp, identity_inserter):
+  """Decorates the references under `comp`, then parses `comp` to TensorFlow.
+
+  Decorating the children of each node immediately before the node is parsed
+  yields the pattern `TFParser` expects at the leaves, so a single postorder
+  walk replaces separate identity-insertion and parsing traversals.
+
+  Args:
+    comp: The `building_blocks.ComputationBuildingBlock` currently being
+      visited in a postorder traversal.
+    identity_inserter: The `transformations.InsertCalledTFIdentityAtLeaves`
+      shared by every node of the traversal.
+
+  Returns:
+    A tuple of the transformed `comp` and a Boolean indicating whether it was
+    modified.
+  """
+  comp, decorated = identity_inserter.transform(comp)
+  comp, parsed = _TF_PARSER(comp)
+  return comp, decorated or parsed
+
+
+def _generate_simple_tensorflow(comp):
+  """Parses `comp` to TensorFlow in a single postorder walk."""
+  if isinstance(comp, building_blocks.CompiledComputation):
+    return comp
+  # A fresh inserter per traversal lets every selection from the same reference
+  # share one identity graph without holding on to references across calls.
+  insert_identity_and_parse = functools.partial(
+      _insert_identity_and_parse,
+      identity_inserter=transformations.InsertCalledTFIdentityAtLeaves(
+          share_decorations=True))
+  generated, _ = transformation_utils.transform_postorder(
+      comp, insert_identity_and_parse)
+  return generated
+
+
 def construct_tensorflow_calling_lambda_on_concrete_arg(
     parameter: building_blocks.Reference,
     body: building_blocks.ComputationBuildingBlock,
@@ -190,39 +289,134 @@ def construct_tensorflow_calling_lambda_on_concrete_arg(
   type_utils.check_equivalent_types(parameter.type_signature,
                                     concrete_arg.type_signature)
 
-  def _generate_simple_tensorflow(comp):
-    tf_parser_callable = transformations.TFParser()
-    comp, _ = transformations.insert_called_tf_identity_at_leaves(comp)
-    comp, _ = transformation_utils.transform_postorder(comp, tf_parser_callable)
-    return comp
-
-  encapsulating_lambda = _generate_simple_tensorflow(
-      building_blocks.Lambda(parameter.name, parameter.type_signature, body))
-  comp_called = _generate_simple_tensorflow(
+  # The postorder walk reduces the lambda to a `CompiledComputation` before it
+  # visits the call, so both can be parsed in a single traversal.
+  encapsulating_lambda = building_blocks.Lambda(parameter.name,
+                                                parameter.type_signature, body)
+  return _generate_simple_tensorflow(
       building_blocks.Call(encapsulating_lambda, concrete_arg))
-  return comp_called
+
+
+class _ReferenceRebinder(object):
+  """Rebinds references to selections from a single argument.
+
+  Every `building_blocks.Reference` under a computation passed to `rebind` is
+  replaced with a selection from `arg_ref`, according to
+  `name_to_output_index`. Selections are interned by index, so that all
+  computations rebound by the same instance share a single selection per
+  index. Computations are walked by direct recursion rather than through
+  `transformation_utils.transform_postorder`, and subtrees containing no
+  references are returned unchanged.
+  """
+
+  __slots__ = ('_arg_ref', '_name_to_output_index', '_selections',
+               '_unbound_refs')
+
+  def __init__(self, arg_ref, name_to_output_index, unbound_refs=None):
+    """Constructs a rebinder for selections from `arg_ref`.
+
+    Args:
+      arg_ref: `building_blocks.Reference` from which the selections are made.
+      name_to_output_index: Mapping from the names of the references to rebind
+        to the index in `arg_ref` which each should select.
+      unbound_refs: Optional Python `dict` as returned by
+        `transformation_utils.get_map_of_unbound_references` for a computation
+        containing those to rebind. If given, subtrees known to contain no
+        reference to a name in `name_to_output_index` are returned without
+        being walked.
+    """
+    self._arg_ref = arg_ref
+    self._name_to_output_index = name_to_output_index
+    self._selections = {}
+    if unbound_refs is None:
+      unbound_refs = {}
+    self._unbound_refs = unbound_refs
+
+  def get_selection(self, index):
+    """Returns the interned selection of `index` from the argument."""
+    selection = self._selections.get(index)
+    if selection is None:
+      selection = building_blocks.Selection(source=self._arg_ref, index=index)
+      self._selections[index] = selection
+    return selection
+
+  def rebind(self, comp):
+    """Returns `comp` with its references replaced by selections."""
+    inner_unbound_refs = self._unbound_refs.get(comp)
+    if (inner_unbound_refs is not None and
+        inner_unbound_refs.isdisjoint(self._name_to_output_index)):
+      return comp
+    elif isinstance(comp, building_blocks.Reference):
+      return self.get_selection(self._name_to_output_index[comp.name])
+    elif isinstance(comp, building_blocks.Selection):
+      source = self.rebind(comp.source)
+      if source is comp.source:
+        return comp
+      return building_blocks.Selection(source, comp.name, comp.index)
+    elif isinstance(comp, building_blocks.Tuple):
+      elements = []
+      elements_modified = False
+      for key, value in anonymous_tuple.iter_elements(comp):
+        new_value = self.rebind(value)
+        elements.append((key, new_value))
+        elements_modified = elements_modified or new_value is not value
+      if not elements_modified:
+        return comp
+      return building_blocks.Tuple(elements)
+    elif isinstance(comp, building_blocks.Call):
+      fn = self.rebind(comp.function)
+      if comp.argument is not None:
+        arg = self.rebind(comp.argument)
+      else:
+        arg = None
+      if fn is comp.function and arg is comp.argument:
+        return comp
+      return building_blocks.Call(fn, arg)
+    elif isinstance(comp, building_blocks.Lambda):
+      result = self.rebind(comp.result)
+      if result is comp.result:
+        return comp
+      return building_blocks.Lambda(comp.parameter_name, comp.parameter_type,
+                                    result)
+    elif isinstance(comp, building_blocks.Block):
+      variables = []
+      variables_modified = False
+      for key, value in comp.locals:
+        new_value = self.rebind(value)
+        variables.append((key, new_value))
+        variables_modified = variables_modified or new_value is not value
+      result = self.rebind(comp.result)
+      if not variables_modified and result is comp.result:
+        return comp
+      return building_blocks.Block(variables, result)
+    return comp
 
 
 def _replace_references_in_comp_with_selections_from_arg(
     comp: building_blocks.ComputationBuildingBlock,
-    arg_ref: building_blocks.Reference, name_to_output_index: Mapping[str,
-                                                                      int]):
-  """Uses `name_to_output_index` to rebind references in `comp`."""
+    arg_ref: building_blocks.Reference,
+    name_to_output_index: Mapping[str, int],
+    unbound_refs: Optional[Mapping[building_blocks.ComputationBuildingBlock,
+                                   Set[str]]] = None):
+  """Uses `name_to_output_index` to rebind references in `comp`.
 
-  def _replace_values_with_selections(inner_comp):
-    if isinstance(inner_comp, building_blocks.Reference):
-      selected_index = name_to_output_index[inner_comp.name]
-      return building_blocks.Selection(
-          source=arg_ref, index=selected_index), True
-    return inner_comp, False
+  Args:
+    comp: Instance of `building_blocks.ComputationBuildingBlock` whose
+      references should be rebound.
+    arg_ref: `building_blocks.Reference` from which the selections are made.
+    name_to_output_index: Mapping from the names of the references under
+      `comp` to the index in `arg_ref` which each should select.
+    unbound_refs: Optional Python `dict` as in `_ReferenceRebinder`.
 
-  comp_replaced, _ = transformation_utils.transform_postorder(
-      comp, _replace_values_with_selections)
-  return comp_replaced
+  Returns:
+    A possibly transformed version of `comp`.
+  """
+  return _ReferenceRebinder(arg_ref, name_to_output_index,
+                            unbound_refs).rebind(comp)
 
 
 def _construct_tensorflow_representing_single_local_assignment(
-    arg_ref, arg_class, previous_output, name_to_output_index):
+    arg_ref, arg_class, previous_output, name_to_output_index, unbound_refs):
   """Constructs TensorFlow to represent assignment to a block local in sequence.
 
   Creates a tuple which represents all computations in the block local sequence
@@ -243,30 +437,46 @@ def _construct_tensorflow_representing_single_local_assignment(
     name_to_output_index: `dict` mapping block local variables to their index in
       the result of the generated TensorFlow. This is used to resolve references
       in the computations of `arg_class`, but will not be modified.
+    unbound_refs: Python `dict` as returned by
+      `transformation_utils.get_map_of_unbound_references` for the block whose
+      locals are being processed; used to skip rebinding subtrees of
+      `arg_class` which reference none of its locals.
 
   Returns:
     Called instance of `building_blocks.CompiledComputation` representing
     the tuple described above.
   """
-  pass_through_args = [
-      building_blocks.Selection(source=arg_ref, index=idx)
-      for idx, _ in enumerate(previous_output.type_signature)
-  ]
-
-  vals_replaced = [
-      _replace_references_in_comp_with_selections_from_arg(
-          c, arg_ref, name_to_output_index) for c in arg_class
-  ]
-  return_tuple = building_blocks.Tuple(pass_through_args + vals_replaced)
+  rebinder = _ReferenceRebinder(arg_ref, name_to_output_index, unbound_refs)
+  pass_through_args = (
+      rebinder.get_selection(idx)
+      for idx in range(len(previous_output.type_signature)))
+  vals_replaced = (rebinder.rebind(c) for c in arg_class)
+  return_tuple = building_blocks.Tuple(
+      itertools.chain(pass_through_args, vals_replaced))
 
   comp_called = construct_tensorflow_calling_lambda_on_concrete_arg(
       arg_ref, return_tuple, previous_output)
   return comp_called
 
 
-def _get_unbound_ref(block):
-  """Helper to get unbound ref name and type spec if it exists in `block`."""
-  all_unbound_refs = transformation_utils.get_map_of_unbound_references(block)
+def _get_unbound_ref(block, all_unbound_refs):
+  """Helper to get unbound ref name and type spec if it exists in `block`.
+
+  Args:
+    block: Instance of `building_blocks.Block` to inspect.
+    all_unbound_refs: The Python `dict` returned by
+      `transformation_utils.get_map_of_unbound_references` for `block`. Since
+      its keys contain every `building_blocks.Reference` under `block`, the
+      type of the unbound reference is read from it rather than from another
+      walk of `block`.
+
+  Returns:
+    A `building_blocks.Reference` representing the single unbound reference
+    in `block`, or `None` if there is none.
+
+  Raises:
+    ValueError: If `block` contains more than one unbound reference.
+  """
   top_level_unbound_ref = all_unbound_refs[block]
   num_unbound_refs = len(top_level_unbound_ref)
   if num_unbound_refs == 0:
@@ -277,19 +487,13 @@ def _get_unbound_ref(block):
                      'encountered the block {} with {} unbound '
                      'references.'.format(block, len(top_level_unbound_ref)))
 
-  unbound_ref_name = top_level_unbound_ref.pop()
-
-  top_level_type_spec = None
-
-  def _get_unbound_ref_type_spec(inner_comp):
-    if (isinstance(inner_comp, building_blocks.Reference) and
-        inner_comp.name == unbound_ref_name):
-      nonlocal top_level_type_spec
-      top_level_type_spec = inner_comp.type_signature
-    return inner_comp, False
-
-  transformation_utils.transform_postorder(block, _get_unbound_ref_type_spec)
-  return building_blocks.Reference(unbound_ref_name, top_level_type_spec)
+  unbound_ref_name = next(iter(top_level_unbound_ref))
+  unbound_ref_type = next(
+      comp.type_signature
+      for comp in all_unbound_refs
+      if isinstance(comp, building_blocks.Reference) and
+      comp.name == unbound_ref_name)
+  return building_blocks.Reference(unbound_ref_name, unbound_ref_type)
 
 
 def _check_parameters_for_tf_block_generation(block):
@@ -304,19 +508,23 @@ def _check_parameters_for_tf_block_generation(block):
           'called TensorFlow computations; encountered a local '
           'bound to {}'.format(comp))
 
-  def _check_contains_only_refs_sels_and_tuples(inner_comp):
-    if not isinstance(inner_comp,
-                      (building_blocks.Reference, building_blocks.Selection,
-                       building_blocks.Tuple)):
+  # Walks `block.result` with an explicit stack, since validation needs
+  # neither the post-order guarantee nor the reconstruction performed by
+  # `transformation_utils.transform_postorder`. The walk stops at the first
+  # offending building block, leaving the rest of the result unvisited.
+  comps_to_check = [block.result]
+  while comps_to_check:
+    inner_comp = comps_to_check.pop()
+    if isinstance(inner_comp, building_blocks.Selection):
+      comps_to_check.append(inner_comp.source)
+    elif isinstance(inner_comp, building_blocks.Tuple):
+      comps_to_check.extend(inner_comp)
+    elif not isinstance(inner_comp, building_blocks.Reference):
       raise ValueError(
           'create_tensorflow_representing_block may only be called '
           'on a block whose result contains only Selections, '
           'Tuples and References; encountered the building block '
           '{}.'.format(inner_comp))
-    return inner_comp, False
-
-  transformation_utils.transform_postorder(
-      block.result, _check_contains_only_refs_sels_and_tuples)
 
 
 def create_tensorflow_representing_block(block):
@@ -360,8 +568,32 @@ def create_tensorflow_representing_block(block):
     arg_name = next(name_generator)
     return building_blocks.Reference(arg_name, arg_type)
 
-  top_level_ref = _get_unbound_ref(block)
-  named_comp_classes = transformations.group_block_locals_by_namespace(block)
+  all_unbound_refs = transformation_utils.get_map_of_unbound_references(block)
+  top_level_ref = _get_unbound_ref(block, all_unbound_refs)
+
+  if not block.locals:
+    # With no locals there is no work to deduplicate, so `block.result` is
+    # parsed directly against the unbound reference, or an empty argument.
+    if top_level_ref:
+      return construct_tensorflow_calling_lambda_on_concrete_arg(
+          top_level_ref, block.result, top_level_ref), True
+    output_comp = building_block_factory.create_compiled_empty_tuple()
+    arg_ref = _construct_reference_representing(output_comp)
+    return construct_tensorflow_calling_lambda_on_concrete_arg(
+        arg_ref, block.result, output_comp), True
+
+  named_comp_classes = _NAMESPACE_GROUPING_CACHE.get(block)
+  if named_comp_classes is None:
+    named_comp_classes = transformations.group_block_locals_by_namespace(block)
+    _NAMESPACE_GROUPING_CACHE[block] = named_comp_classes
+
+  block_local_names = frozenset(x[0] for x in block.locals)
+
+  def _update_name_to_output_index(named_comp_class, offset):
+    """Helper closing over `name_to_output_index` and `block_local_names`."""
+    for idx, (name, _) in enumerate(named_comp_class, start=offset):
+      if name in block_local_names:
+        name_to_output_index[name] = idx
 
   if top_level_ref:
     first_comps = [x[1] for x in named_comp_classes[0]]
@@ -369,39 +601,33 @@ def create_tensorflow_representing_block(block):
     output_comp = construct_tensorflow_calling_lambda_on_concrete_arg(
         top_level_ref, tup, top_level_ref)
     name_to_output_index = {top_level_ref.name: 0}
+    _update_name_to_output_index(named_comp_classes[0], 1)
+    remaining_comp_classes = named_comp_classes[1:]
   else:
     output_comp = building_block_factory.create_compiled_empty_tuple()
     name_to_output_index = {}
+    remaining_comp_classes = named_comp_classes
 
-  block_local_names = [x[0] for x in block.locals]
-
-  def _update_name_to_output_index(name_class):
-    """Helper closing over `name_to_output_index` and `block_local_names`."""
-    offset = len(name_to_output_index.keys())
-    for idx, comp_name in enumerate(name_class):
-      for var_name in block_local_names:
-        if var_name == comp_name:
-          name_to_output_index[var_name] = idx + offset
-
-  if top_level_ref:
-    first_names = [x[0] for x in named_comp_classes[0]]
-    _update_name_to_output_index(first_names)
-    remaining_comp_classes = named_comp_classes[1:]
-  else:
-    remaining_comp_classes = named_comp_classes[:]
-
+  # Classes are processed in order, since each step is called on `output_comp`,
+  # the compiled output of the step before it. The indices of a class are only
+  # recorded once it has been processed, since a later local may shadow an
+  # earlier one.
   for named_comp_class in remaining_comp_classes:
     if named_comp_class:
       comp_class = [x[1] for x in named_comp_class]
-      name_class = [x[0] for x in named_comp_class]
+      offset = len(output_comp.type_signature)
       arg_ref = _construct_reference_representing(output_comp)
       output_comp = _construct_tensorflow_representing_single_local_assignment(
-          arg_ref, comp_class, output_comp, name_to_output_index)
-      _update_name_to_output_index(name_class)
+          arg_ref, comp_class, output_comp, name_to_output_index,
+          all_unbound_refs)
+      _update_name_to_output_index(named_comp_class, offset)
 
   arg_ref = _construct_reference_representing(output_comp)
   result_replaced = _replace_references_in_comp_with_selections_from_arg(
-      block.result, arg_ref, name_to_output_index)
+      block.result,
+      arg_ref,
+      name_to_output_index,
+      unbound_refs=all_unbound_refs)
   comp_called = construct_tensorflow_calling_lambda_on_concrete_arg(
       arg_ref, result_replaced, output_comp)
 
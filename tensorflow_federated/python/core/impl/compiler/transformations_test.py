@@ -107,8 +107,55 @@ class RemoveLambdasAndBlocksTest(common_test.TestCase):
                                                  called_inner_lambda)
     lambdas_and_blocks_removed, modified = compiler_transformations.remove_lambdas_and_blocks(
         higher_level_lambda)
+    self.assertFalse(modified)
+    self.assertNoLambdasOrBlocks(lambdas_and_blocks_removed)
+
+  def test_does_not_capture_unbound_reference_with_unique_names(self):
+    unbound_ref = building_blocks.Reference('x', tf.int32)
+    lam = building_blocks.Lambda('x', tf.float32,
+                                 building_blocks.Reference('y', tf.int32))
+    blk = building_blocks.Block([('y', unbound_ref)], lam)
+    lambdas_and_blocks_removed, modified = compiler_transformations.remove_lambdas_and_blocks(
+        blk)
+    self.assertTrue(modified)
+    self.assertNoLambdasOrBlocks(lambdas_and_blocks_removed)
+    self.assertIsInstance(lambdas_and_blocks_removed, building_blocks.Lambda)
+    self.assertNotEqual(lambdas_and_blocks_removed.parameter_name, 'x')
+    self.assertEqual(lambdas_and_blocks_removed.result.name, 'x')
+
+  def test_with_called_lambda_calling_its_parameter(self):
+    identity_lam = building_blocks.Lambda(
+        'x', tf.int32, building_blocks.Reference('x', tf.int32))
+    ref_to_fn = building_blocks.Reference('fn', identity_lam.type_signature)
+    data = building_blocks.Data('a', tf.int32)
+    higher_level_lambda = building_blocks.Lambda(
+        'fn', identity_lam.type_signature,
+        building_blocks.Call(ref_to_fn, data))
+    called_higher_level_lambda = building_blocks.Call(higher_level_lambda,
+                                                      identity_lam)
+    lambdas_and_blocks_removed, modified = compiler_transformations.remove_lambdas_and_blocks(
+        called_higher_level_lambda)
+    self.assertTrue(modified)
+    self.assertNoLambdasOrBlocks(lambdas_and_blocks_removed)
+    self.assertEqual(lambdas_and_blocks_removed.compact_representation(), 'a')
+
+  def test_with_called_lambda_binding_outer_parameter(self):
+    function_type = computation_types.FunctionType(tf.int32, tf.int32)
+    data = building_blocks.Data('a', tf.int32)
+    inner_lambda = building_blocks.Lambda(
+        'f', function_type,
+        building_blocks.Call(
+            building_blocks.Reference('f', function_type), data))
+    called_inner_lambda = building_blocks.Call(
+        inner_lambda, building_blocks.Reference('y', function_type))
+    outer_lambda = building_blocks.Lambda('y', function_type,
+                                          called_inner_lambda)
+    lambdas_and_blocks_removed, modified = compiler_transformations.remove_lambdas_and_blocks(
+        outer_lambda)
     self.assertTrue(modified)
     self.assertNoLambdasOrBlocks(lambdas_and_blocks_removed)
+    self.assertEqual(lambdas_and_blocks_removed.compact_representation(),
+                     '(y -> y(a))')
 
   def test_with_multiple_reference_indirection(self):
     identity_lam = building_blocks.Lambda(
@@ -265,6 +312,22 @@ class BlockLocalsTFGraphTest(common_test.TestCase):
     with self.assertRaises(ValueError):
       compiler_transformations.create_tensorflow_representing_block(block)
 
+  def test_raises_with_lambda_nested_in_result(self):
+    ref_to_int = building_blocks.Reference('var', tf.int32)
+    first_tf_id = building_block_factory.create_compiled_identity(tf.int32)
+    called_tf_id = building_blocks.Call(first_tf_id, ref_to_int)
+    block_locals = [('call', called_tf_id)]
+    ref_to_call = building_blocks.Reference('call', called_tf_id.type_signature)
+    lam = building_blocks.Lambda(ref_to_call.name, ref_to_call.type_signature,
+                                 ref_to_call)
+    inner_tuple = building_blocks.Tuple([ref_to_call, lam])
+    selection = building_blocks.Selection(
+        building_blocks.Tuple([inner_tuple]), index=0)
+    result = building_blocks.Tuple([ref_to_call, selection])
+    block = building_blocks.Block(block_locals, result)
+    with self.assertRaises(ValueError):
+      compiler_transformations.create_tensorflow_representing_block(block)
+
   def test_returns_correct_structure_with_tuple_in_result(self):
     ref_to_int = building_blocks.Reference('var', tf.int32)
     first_tf_id = building_block_factory.create_compiled_identity(tf.int32)
@@ -351,6 +414,46 @@ class BlockLocalsTFGraphTest(common_test.TestCase):
     result = test_utils.run_tensorflow(tf_representing_block.function.proto)
     self.assertAllEqual(result, [1, 1])
 
+  def test_executes_correctly_with_shadowed_local(self):
+    ref_to_int = building_blocks.Reference('var', tf.int32)
+    first_tf_id = building_block_factory.create_compiled_identity(tf.int32)
+    first_called = building_blocks.Call(first_tf_id, ref_to_int)
+    ref_to_a = building_blocks.Reference('a', first_called.type_signature)
+    second_tf_id = building_block_factory.create_compiled_identity(tf.int32)
+    second_called = building_blocks.Call(second_tf_id, ref_to_a)
+    ref_to_b = building_blocks.Reference('b', second_called.type_signature)
+    third_tf_id = building_block_factory.create_compiled_identity(tf.int32)
+    third_called = building_blocks.Call(third_tf_id, ref_to_b)
+    block_locals = [('a', first_called), ('b', second_called),
+                    ('a', third_called)]
+    block = building_blocks.Block(block_locals,
+                                  building_blocks.Tuple([ref_to_a, ref_to_b]))
+    tf_representing_block, _ = compiler_transformations.create_tensorflow_representing_block(
+        block)
+    self.assertEqual(tf_representing_block.type_signature, block.type_signature)
+    self.assertIsInstance(tf_representing_block, building_blocks.Call)
+    self.assertIsInstance(tf_representing_block.function,
+                          building_blocks.CompiledComputation)
+    result = test_utils.run_tensorflow(tf_representing_block.function.proto, 1)
+    self.assertAllEqual(result, [1, 1])
+
+  def test_returns_single_called_graph_with_no_locals(self):
+    ref_to_int = building_blocks.Reference('var', tf.int32)
+    block = building_blocks.Block([],
+                                  building_blocks.Tuple(
+                                      [ref_to_int, ref_to_int]))
+    tf_representing_block, _ = compiler_transformations.create_tensorflow_representing_block(
+        block)
+    self.assertEqual(tf_representing_block.type_signature, block.type_signature)
+    self.assertIsInstance(tf_representing_block, building_blocks.Call)
+    self.assertIsInstance(tf_representing_block.function,
+                          building_blocks.CompiledComputation)
+    self.assertIsInstance(tf_representing_block.argument,
+                          building_blocks.Reference)
+    self.assertEqual(tf_representing_block.argument.name, 'var')
+    result = test_utils.run_tensorflow(tf_representing_block.function.proto, 1)
+    self.assertAllEqual(result, [1, 1])
+
   def test_returns_single_called_graph_with_selection_in_result(self):
     ref_to_tuple = building_blocks.Reference('var', [tf.int32, tf.int32])
     first_tf_id = building_block_factory.create_compiled_identity(
@@ -1460,6 +1460,96 @@ def group_block_locals_by_namespace(block):
   return comp_classes
 
 
+class InsertCalledTFIdentityAtLeaves(transformation_utils.TransformSpec):
+  """Wraps TensorFlow-compatible references in a called identity graph.
+
+  The transformation looks only at the immediate children of the computation
+  it is given, so it may be applied node by node during a postorder traversal
+  alongside other transformations; see `insert_called_tf_identity_at_leaves`.
+
+  If constructed with `share_decorations=True`, each reference is decorated at
+  most once per instance, so many selections from the same reference share a
+  single called identity graph rather than each constructing their own. The
+  result is then no longer a tree, so this is off by default.
+  """
+
+  def __init__(self, share_decorations=False):
+    """Constructs the transformation.
+
+    Args:
+      share_decorations: Python `bool`; whether to reuse the called identity
+        graph constructed for a reference wherever that reference is decorated.
+    """
+    super().__init__()
+    if share_decorations:
+      self._decorated_references = {}
+    else:
+      self._decorated_references = None
+
+  def _should_decorate(self, comp):
+    return (isinstance(comp, building_blocks.Reference) and
+            type_utils.is_tensorflow_compatible_type(comp.type_signature))
+
+  def _decorate(self, comp):
+    if self._decorated_references is not None:
+      decorated = self._decorated_references.get(comp)
+      if decorated is not None:
+        return decorated
+    identity_function = building_block_factory.create_compiled_identity(
+        comp.type_signature)
+    decorated = building_blocks.Call(identity_function, comp)
+    if self._decorated_references is not None:
+      self._decorated_references[comp] = decorated
+    return decorated
+
+  def should_transform(self, comp):
+    if isinstance(comp, building_blocks.Tuple):
+      return any(self._should_decorate(x) for x in comp)
+    elif isinstance(comp, building_blocks.Call):
+      return (not isinstance(comp.function,
+                              building_blocks.CompiledComputation) and
+              self._should_decorate(comp.argument))
+    elif isinstance(comp, building_blocks.Selection):
+      return self._should_decorate(comp.source)
+    elif isinstance(comp, building_blocks.Lambda):
+      return self._should_decorate(comp.result)
+    elif isinstance(comp, building_blocks.Block):
+      return (any(self._should_decorate(x[1]) for x in comp.locals) or
+              self._should_decorate(comp.result))
+    return False
+
+  def transform(self, comp):
+    if not self.should_transform(comp):
+      return comp, False
+    if isinstance(comp, building_blocks.Tuple):
+      elems = []
+      for x in anonymous_tuple.iter_elements(comp):
+        if self._should_decorate(x[1]):
+          elems.append((x[0], self._decorate(x[1])))
+        else:
+          elems.append((x[0], x[1]))
+      return building_blocks.Tuple(elems), True
+    elif isinstance(comp, building_blocks.Call):
+      arg = self._decorate(comp.argument)
+      return building_blocks.Call(comp.function, arg), True
+    elif isinstance(comp, building_blocks.Selection):
+      return building_blocks.Selection(
+          self._decorate(comp.source), name=comp.name, index=comp.index), True
+    elif isinstance(comp, building_blocks.Lambda):
+      return building_blocks.Lambda(comp.parameter_name, comp.parameter_type,
+                                    self._decorate(comp.result)), True
+    new_locals = []
+    for x in comp.locals:
+      if self._should_decorate(x[1]):
+        new_locals.append((x[0], self._decorate(x[1])))
+      else:
+        new_locals.append((x[0], x[1]))
+    new_result = comp.result
+    if self._should_decorate(comp.result):
+      new_result = self._decorate(comp.result)
+    return building_blocks.Block(new_locals, new_result), True
+
+
 def insert_called_tf_identity_at_leaves(comp):
   r"""Inserts an identity TF graph called on References under `comp`.
 
@@ -1506,56 +1596,7 @@ def insert_called_tf_identity_at_leaves(comp):
   if isinstance(comp, building_blocks.CompiledComputation):
     return comp, False
 
-  def _should_decorate(comp):
-    return (isinstance(comp, building_blocks.Reference) and
-            type_utils.is_tensorflow_compatible_type(comp.type_signature))
-
-  def _decorate(comp):
-    identity_function = building_block_factory.create_compiled_identity(
-        comp.type_signature)
-    return building_blocks.Call(identity_function, comp)
-
-  def _decorate_if_reference_without_graph(comp):
-    """Decorates references under `comp` if necessary."""
-    if (isinstance(comp, building_blocks.Tuple) and
-        any(_should_decorate(x) for x in comp)):
-      elems = []
-      for x in anonymous_tuple.iter_elements(comp):
-        if _should_decorate(x[1]):
-          elems.append((x[0], _decorate(x[1])))
-        else:
-          elems.append((x[0], x[1]))
-      return building_blocks.Tuple(elems), True
-    elif (isinstance(comp, building_blocks.Call) and
-          not isinstance(comp.function, building_blocks.CompiledComputation) and
-          _should_decorate(comp.argument)):
-      arg = _decorate(comp.argument)
-      return building_blocks.Call(comp.function, arg), True
-    elif (isinstance(comp, building_blocks.Selection) and
-          _should_decorate(comp.source)):
-      return building_blocks.Selection(
-          _decorate(comp.source), name=comp.name, index=comp.index), True
-    elif (isinstance(comp, building_blocks.Lambda) and
-          _should_decorate(comp.result)):
-      return building_blocks.Lambda(comp.parameter_name, comp.parameter_type,
-                                    _decorate(comp.result)), True
-    elif isinstance(comp, building_blocks.Block) and (
-        any(_should_decorate(x[1]) for x in comp.locals) or
-        _should_decorate(comp.result)):
-      new_locals = []
-      for x in comp.locals:
-        if _should_decorate(x[1]):
-          new_locals.append((x[0], _decorate(x[1])))
-        else:
-          new_locals.append((x[0], x[1]))
-      new_result = comp.result
-      if _should_decorate(comp.result):
-        new_result = _decorate(comp.result)
-      return building_blocks.Block(new_locals, new_result), True
-    return comp, False
-
-  return transformation_utils.transform_postorder(
-      comp, _decorate_if_reference_without_graph)
+  return _apply_transforms(comp, InsertCalledTFIdentityAtLeaves())
 
 
 def unwrap_placement(comp):
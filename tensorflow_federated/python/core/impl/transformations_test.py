@@ -4136,6 +4136,19 @@ class InsertTensorFlowIdentityAtLeavesTest(common_test.TestCase):
     self.assertEqual(transformed_tuple[0].argument.type_signature,
                      computation_types.to_type(tf.int32))
 
+  def test_does_not_share_decorations_of_same_reference(self):
+    ref_to_x = building_blocks.Reference('x', [tf.int32, tf.int32])
+    tup = building_blocks.Tuple([
+        building_blocks.Selection(ref_to_x, index=0),
+        building_blocks.Selection(ref_to_x, index=1)
+    ])
+    transformed_tuple, _ = transformations.insert_called_tf_identity_at_leaves(
+        tup)
+    self.assertIsNot(transformed_tuple[0].source, transformed_tuple[1].source)
+    self.assertEqual(
+        tree_analysis.count_types(transformed_tuple,
+                                  building_blocks.CompiledComputation), 2)
+
   def test_does_not_transform_references_to_federated_types(self):
     fed_type = computation_types.FederatedType(tf.int32, placements.CLIENTS)
     identity_lam = building_blocks.Lambda(